@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[1]:
+
+
+# Imports
+import json
+import os
+
+from affine import Affine
+import geopandas as gpd
+import numpy as np
+from rasterio import features
+import rioxarray as rxr
+from shapely.geometry import shape
+
+
+# In[2]:
+
+
+# Function to build the flood index from a clipped REM file
+def build_rem_index(rem_path, index_dir, zones_gdf=None, zone_column=None,
+                    pixel_area=None):
+    """Precomputes a REM index for fast flood scenario queries
+
+    Parameters
+    ------------
+    rem_path: str
+        Path to the REM raster (e.g. the REMMaker clipped dtm REM).
+    index_dir: str
+        Directory to save the index files in.
+    zones_gdf: geodataframe
+        Optional zones (e.g. parcels) to precompute the minimum REM of.
+    zone_column: str
+        Column of zones_gdf with the zone ids (default = the gdf index).
+    pixel_area: float
+        Area of one pixel (default = from the raster resolution).
+
+    Returns
+    ------------
+    index_dir: str
+        Path to the directory with the saved index.
+    """
+
+    if not os.path.exists(index_dir):
+        print('{} does not exist. Creating...'.format(index_dir))
+        os.makedirs(index_dir)
+
+    rem = rxr.open_rasterio(rem_path, masked=True).squeeze()
+    rem_values = rem.values.ravel()
+    transform = rem.rio.transform()
+    if pixel_area is None:
+        x_res, y_res = rem.rio.resolution()
+        pixel_area = abs(x_res * y_res)
+
+    # Sort the valid pixels from lowest to highest REM
+    valid_pixels = np.flatnonzero(~np.isnan(rem_values))
+    pixel_order = valid_pixels[np.argsort(rem_values[valid_pixels],
+                                          kind='stable')]
+    sorted_rem = rem_values[pixel_order].astype('float32')
+
+    np.save(os.path.join(index_dir, 'sorted_rem.npy'), sorted_rem)
+    np.save(os.path.join(index_dir, 'pixel_order.npy'), pixel_order)
+
+    # Minimum REM of each zone = REM of its first pixel in sorted order.
+    # All touched pixels count, so zones smaller than a pixel still get
+    # the REM of the pixel(s) they fall in (where zones share a pixel,
+    # the later zone gets it)
+    zone_ids = []
+    if zones_gdf is not None:
+        zones_gdf = zones_gdf.to_crs(rem.rio.crs)
+        if zone_column is None:
+            zone_ids = list(zones_gdf.index)
+        else:
+            zone_ids = list(zones_gdf[zone_column])
+        zone_raster = features.rasterize(
+            zip(zones_gdf.geometry, range(1, len(zone_ids) + 1)),
+            out_shape=rem.shape, transform=transform, fill=0,
+            all_touched=True, dtype='int32').ravel()
+        sorted_zones = zone_raster[pixel_order]
+        zones, first_pixels = np.unique(sorted_zones, return_index=True)
+        zone_min = np.full(len(zone_ids) + 1, np.nan, dtype='float32')
+        zone_min[zones] = sorted_rem[first_pixels]
+        np.save(os.path.join(index_dir, 'zone_min.npy'), zone_min[1:])
+
+    metadata = {'rem_path': rem_path,
+                'shape': list(rem.shape),
+                'transform': list(transform)[:6],
+                'crs': rem.rio.crs.to_wkt(),
+                'pixel_area': pixel_area,
+                'zone_ids': [str(zone_id) for zone_id in zone_ids]}
+    with open(os.path.join(index_dir, 'metadata.json'), 'w') as metadata_file:
+        json.dump(metadata, metadata_file)
+
+    return index_dir
+
+
+# In[3]:
+
+
+# Function to load the flood index as memory mapped arrays
+def load_rem_index(index_dir):
+    """Loads a saved REM index without reading the arrays into memory
+
+    Parameters
+    ------------
+    index_dir: str
+        Directory with the saved index.
+
+    Returns
+    ------------
+    rem_index: dictionary
+        A dictionary with the memory mapped arrays and raster metadata.
+    """
+
+    with open(os.path.join(index_dir, 'metadata.json')) as metadata_file:
+        rem_index = json.load(metadata_file)
+    rem_index['shape'] = tuple(rem_index['shape'])
+    rem_index['transform'] = Affine(*rem_index['transform'])
+    rem_index['zone_lookup'] = {zone_id: i for i, zone_id
+                                in enumerate(rem_index['zone_ids'])}
+
+    for name in ['sorted_rem', 'pixel_order', 'zone_min']:
+        array_path = os.path.join(index_dir, '{}.npy'.format(name))
+        if os.path.exists(array_path):
+            rem_index[name] = np.load(array_path, mmap_mode='r')
+
+    return rem_index
+
+
+# In[4]:
+
+
+# Functions to query flood scenarios from the index
+def flooded_pixel_count(rem_index, stage):
+    """Returns the number of pixels with a REM at or below the stage"""
+
+    return int(np.searchsorted(rem_index['sorted_rem'], stage, side='right'))
+
+
+def flooded_area(rem_index, stage):
+    """Returns the area inundated at a water level (stage)
+
+    Only valid REM pixels are counted, unlike flood_map which also
+    counts nodata pixels as inundated.
+    """
+
+    return flooded_pixel_count(rem_index, stage) * rem_index['pixel_area']
+
+
+def stage_for_area(rem_index, area):
+    """Returns the lowest stage that inundates at least the given area"""
+
+    # Index of the last pixel needed, i.e. ceil(area / pixel area) - 1
+    count = max(int(np.ceil(area / rem_index['pixel_area'])) - 1, 0)
+    if count >= rem_index['sorted_rem'].size:
+        return np.nan
+    return float(rem_index['sorted_rem'][count])
+
+
+def zone_flood_stage(rem_index, zone_id):
+    """Returns the stage at which a zone (e.g. a parcel) first gets wet"""
+
+    zone = rem_index['zone_lookup'][str(zone_id)]
+    return float(rem_index['zone_min'][zone])
+
+
+def flood_mask(rem_index, stage):
+    """Returns a boolean array of the pixels inundated at a stage"""
+
+    count = flooded_pixel_count(rem_index, stage)
+    mask = np.zeros(np.prod(rem_index['shape']), dtype=bool)
+    mask[rem_index['pixel_order'][:count]] = True
+    return mask.reshape(rem_index['shape'])
+
+
+def flood_polygons(rem_index, stage):
+    """Returns a geodataframe of the areas inundated at a stage"""
+
+    mask = flood_mask(rem_index, stage)
+    geometry = [shape(geom) for geom, value in features.shapes(
+        mask.astype('uint8'), mask=mask, transform=rem_index['transform'])]
+    polygons_gdf = gpd.GeoDataFrame(geometry=geometry, crs=rem_index['crs'])
+    polygons_gdf['stage'] = stage
+    polygons_gdf['area'] = polygons_gdf.area
+    return polygons_gdf
@@ -5,27 +5,198 @@
 
 
 # Imports
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import os
 import glob
+import json
 import pathlib
 import re
 import requests
+import tempfile
 import zipfile
 
+from affine import Affine
 import geopandas as gpd
 from IPython.display import clear_output
+from matplotlib.figure import Figure
 import matplotlib.pyplot as plt
 import numpy as np
 from PIL import Image
+from rasterio import features
 from riverrem.REMMaker import REMMaker, clear_osm_cache
 import rioxarray as rxr
+import shapely
+from shapely.geometry import shape
+from shapely.ops import linemerge, polygonize, unary_union
+from shapely.prepared import prep
+import xarray as xr
 
 
 # In[2]:
 
 
+# Functions to share site rasters between processes with a memory mapped store
+def save_store_layer(store_dir, site_name, layer, model, chunk_rows=256):
+    """Saves a dataarray to the raster store as a .npy file and metadata
+    
+    Parameters
+    ----------
+    store_dir: str
+        The directory of the raster store.
+    site_name: str
+        The name of the site.
+    layer: str
+        The name of the layer (load_dtm uses the file name without
+        extension, e.g. 'hallmeadows_rem').
+    model: dataarray
+        The dataarray to save.
+    chunk_rows: int
+        The number of rows read together by iter_store_chunks.
+        
+    Returns
+    ---------
+    layer_path: str
+        Path to the saved .npy file.
+    """
+    
+    site_dir = os.path.join(store_dir, site_name)
+    if not os.path.exists(site_dir):
+        print('{} does not exist. Creating...'.format(site_dir))
+        os.makedirs(site_dir)
+    metadata_path = os.path.join(site_dir, '{}.json'.format(layer))
+    
+    # Never rewrite a .npy in place, other processes may have it memory 
+    # mapped. Each save writes a new data file, and the metadata that 
+    # points to it is swapped in with os.replace, so readers always get 
+    # a matching pair
+    data_fd, layer_path = tempfile.mkstemp(
+        prefix='{}.'.format(layer), suffix='.npy', dir=site_dir)
+    with os.fdopen(data_fd, 'wb') as data_file:
+        np.save(data_file, np.ascontiguousarray(model.values))
+    
+    # Rasters without a CRS are stored with crs = None
+    crs = model.rio.crs
+    metadata = {'data_file': os.path.basename(layer_path),
+                'dims': list(model.dims),
+                'shape': list(model.shape),
+                'dtype': str(model.dtype),
+                'crs': crs.to_wkt() if crs is not None else None,
+                'transform': list(model.rio.transform())[:6],
+                'chunk_rows': chunk_rows}
+    old_data_file = _store_data_file(metadata_path)
+    metadata_fd, temp_path = tempfile.mkstemp(
+        prefix='{}.'.format(layer), suffix='.json.tmp', dir=site_dir)
+    with os.fdopen(metadata_fd, 'w') as metadata_file:
+        json.dump(metadata, metadata_file)
+    os.replace(temp_path, metadata_path)
+    
+    # Unlinking the old data file keeps existing memory maps valid
+    if old_data_file is not None:
+        try:
+            os.remove(os.path.join(site_dir, old_data_file))
+        except OSError:
+            pass
+    return layer_path
+
+
+def _store_data_file(metadata_path):
+    """Returns the data file named by a layer's metadata, or None"""
+    
+    if not os.path.exists(metadata_path):
+        return None
+    with open(metadata_path) as metadata_file:
+        metadata = json.load(metadata_file)
+    layer = os.path.splitext(os.path.basename(metadata_path))[0]
+    return metadata.get('data_file', '{}.npy'.format(layer))
+
+
+def open_store_layer(store_dir, site_name, layer):
+    """Opens a layer of the raster store without copying it into memory
+    
+    Parameters
+    ----------
+    store_dir: str
+        The directory of the raster store.
+    site_name: str
+        The name of the site.
+    layer: str
+        The name of the layer.
+        
+    Returns
+    ---------
+    model : dataarray
+        A dataarray backed by the memory mapped file, or None if the 
+        layer is not in the store.
+    """
+    
+    site_dir = os.path.join(store_dir, site_name)
+    metadata_path = os.path.join(site_dir, '{}.json'.format(layer))
+    
+    # Retry once if the layer was saved again between reading the 
+    # metadata and opening its (now removed) data file
+    for attempt in range(2):
+        if not os.path.exists(metadata_path):
+            return None
+        with open(metadata_path) as metadata_file:
+            metadata = json.load(metadata_file)
+        layer_path = os.path.join(site_dir, metadata.get(
+            'data_file', '{}.npy'.format(layer)))
+        try:
+            values = np.load(layer_path, mmap_mode='r')
+            break
+        except FileNotFoundError:
+            if attempt == 1:
+                raise
+    
+    # Rebuild pixel center coordinates from the transform
+    transform = Affine(*metadata['transform'])
+    coords = {}
+    for dim, size in zip(metadata['dims'], metadata['shape']):
+        if dim == 'x':
+            coords[dim] = transform.c + transform.a * (np.arange(size) + 0.5)
+        elif dim == 'y':
+            coords[dim] = transform.f + transform.e * (np.arange(size) + 0.5)
+        else:
+            coords[dim] = np.arange(1, size + 1)
+    
+    model = xr.DataArray(values, dims=metadata['dims'], coords=coords)
+    if metadata['crs'] is not None:
+        model = model.rio.write_crs(metadata['crs'])
+    model = model.rio.write_transform(transform)
+    model.attrs['chunk_rows'] = metadata['chunk_rows']
+    return model
+
+
+def iter_store_chunks(store_dir, site_name, layer):
+    """Yields the row slices and values of a store layer chunk by chunk"""
+    
+    model = open_store_layer(store_dir, site_name, layer)
+    chunk_rows = model.attrs['chunk_rows']
+    for start in range(0, model.sizes['y'], chunk_rows):
+        rows = slice(start, start + chunk_rows)
+        yield rows, model.isel(y=rows).values
+
+
+def store_raster(store_dir, site_name, raster_path):
+    """Opens a raster file from the store, saving it there the first time
+
+    The layer is named after the file name without extension.
+    """
+    
+    layer = os.path.splitext(os.path.basename(raster_path))[0]
+    model = open_store_layer(store_dir, site_name, layer)
+    if model is None:
+        save_store_layer(store_dir, site_name, layer, 
+                         rxr.open_rasterio(raster_path, masked=True))
+        model = open_store_layer(store_dir, site_name, layer)
+    return model
+
+
+# In[3]:
+
+
 # Function to download and load dtm as data array
-def load_dtm(site_name, data_url, file_name):
+def load_dtm(site_name, data_url, file_name, store_dir=None):
     """Creates DataArray of Elevation Model Data
     
     Parameters
@@ -36,6 +207,9 @@ def load_dtm(site_name, data_url, file_name):
         Url to the dataset (a .tif or zipfile containing .asc and .prj).
     file_name: str
         The name of the datafile.
+    store_dir: str
+        Optional raster store directory. The dtm is saved to the store 
+        the first time and opened from it afterwards.
         
     Returns
     ---------
@@ -44,6 +218,13 @@ def load_dtm(site_name, data_url, file_name):
 
     """
     
+    # Open from the raster store if the dtm was already saved there
+    layer = os.path.splitext(file_name)[0]
+    if store_dir is not None:
+        dtm = open_store_layer(store_dir, site_name, layer)
+        if dtm is not None:
+            return dtm
+    
     override_cache = False
     data_dir = site_name
     data_path = os.path.join(data_dir, file_name)
@@ -58,6 +239,12 @@ def load_dtm(site_name, data_url, file_name):
               'the download may take awhile'.format(data_path))
         # Download full data file as zipfile
         response = requests.get(data_url)
+        
+        # Don't cache error pages (e.g. a 404 for an unknown site)
+        if not response.ok:
+            print('Download of {} failed with status {}'.format(
+                data_url, response.status_code))
+            return None
 
         # Write in respose content using context manager
         with open(data_path, 'wb') as data_file:
@@ -74,12 +261,17 @@ def load_dtm(site_name, data_url, file_name):
     # Open and plot the UAV DTMs
     try:
         dtm = rxr.open_rasterio(data_path, masked=True)
-        return dtm
     except:
         print('file type not supported, check your download')
+        return None
+    
+    if store_dir is not None:
+        save_store_layer(store_dir, site_name, layer, dtm)
+        dtm = open_store_layer(store_dir, site_name, layer)
+    return dtm
 
 
-# In[3]:
+# In[4]:
 
 
 # Function to create dictionary to store info for lidar download
@@ -114,7 +306,7 @@ def get_lidar_url(site_names):
 
 
 # Function to add rems and dtms to dictionary dictionary
-def get_uav_dtms(site_data_dictionary):
+def get_uav_dtms(site_data_dictionary, store_dir=None):
     """
     Adds UAV info to dictionary.
     
@@ -122,6 +314,8 @@ def get_uav_dtms(site_data_dictionary):
     -------------
     site_data_dictionary: list
         List of the dictionaries with site data.
+    store_dir: str
+        Optional raster store directory shared with worker processes.
     
     Returns
     ------------
@@ -135,13 +329,15 @@ def get_uav_dtms(site_data_dictionary):
                                              .format(site['site_name'])), 
                                      site_name=site['site_name'],
                                      file_name=('{}_rem.tif'
-                                                .format(site['site_name'])))
+                                                .format(site['site_name'])),
+                                     store_dir=store_dir)
         site['uav_dtm'] = load_dtm(data_url=('https://zenodo.org/record/'
                                              '8218054/files/{}_uav_dtm.tif?download=1'
                                              .format(site['site_name'])), 
                                      site_name=site['site_name'],
                                      file_name=('{}_dtm.tif'
-                                                .format(site['site_name'])))
+                                                .format(site['site_name'])),
+                                     store_dir=store_dir)
             
     return site_data_dictionary
 
@@ -150,7 +346,7 @@ def get_uav_dtms(site_data_dictionary):
 
 
 ##Function to get the bounding polygon and save as gdf
-def get_boundary_gdf(data_url, site_name):
+def get_boundary_gdf(data_url, site_name, working_dir=None):
     """Downloads boundary shapefiles and open as a gdf
     
     Parameters
@@ -160,6 +356,10 @@ def get_boundary_gdf(data_url, site_name):
     
     site_name: str
         The site name.
+    
+    working_dir: str
+        Directory to extract the shapefiles to (default = 
+        home/st-vrain-rem-wkdir/data).
         
     Returns
     ------------
@@ -168,14 +368,16 @@ def get_boundary_gdf(data_url, site_name):
     """
     override_cache = False
     data_path = os.path.join('shapefiles.zip')
-    working_dir = os.path.join(
-    pathlib.Path.home(), 'st-vrain-rem-wkdir', 'data')
+    if working_dir is None:
+        working_dir = os.path.join(
+        pathlib.Path.home(), 'st-vrain-rem-wkdir', 'data')
     
     # Cache data file
     if (not os.path.exists(data_path)) or override_cache:
         print('{} does not exist. Downloading...'.format(data_path))
         # Download full data file as zipfile
         response = requests.get(data_url)
+        response.raise_for_status()
 
         # Write in respose content using context manager
         with open(data_path, 'wb') as data_file:
@@ -183,7 +385,7 @@ def get_boundary_gdf(data_url, site_name):
             
     with zipfile.ZipFile(data_path, 'r') as shape_zipfile:
         shape_zipfile.extractall(working_dir)
-    data_path=os.path.join('shapefiles',
+    data_path=os.path.join(working_dir, 'shapefiles',
                            '{}_bounding_polygon'.format(site_name),
                            'Bounding_Polygon.shp')
     
@@ -200,7 +402,8 @@ def get_boundary_gdf(data_url, site_name):
 
 
 # Function to clip the LiDAR and UAV DTMs to the REM bounding polygon
-def dtm_clip(site_name, site_dtm, clip_gdf, is_lidar):
+def dtm_clip(site_name, site_dtm, clip_gdf, is_lidar, store_dir=None,
+             override_store=False):
     """
   Clips the UAV and LiDAR DTM to the area of interest (AOI) using a 
   supplied shapefile. Reprojects the LiDAR to match UAV CRS.
@@ -215,6 +418,11 @@ def dtm_clip(site_name, site_dtm, clip_gdf, is_lidar):
       GDF of the AOI.
   is_lidar: Bool.
       Is the dtm from lidar? True = yes, False = no.
+  store_dir: Str
+      Optional raster store directory to also save the clipped dtm to.
+  override_store: Bool
+      Replace the clipped dtm if it is already in the store? 
+      True = yes, False = no (the stored layer is returned).
 
   Returns
   -------
@@ -240,6 +448,15 @@ def dtm_clip(site_name, site_dtm, clip_gdf, is_lidar):
     # Save the clipped lidar or uav dtm as raster for use in RiverREM function
     clipped_dtm.rio.to_raster(raster_path)
     
+    # Save the clipped dtm to the raster store and return the shared copy
+    if store_dir is not None:
+        layer = os.path.splitext(os.path.basename(raster_path))[0]
+        stored_dtm = open_store_layer(store_dir, site_name, layer)
+        if stored_dtm is None or override_store:
+            save_store_layer(store_dir, site_name, layer, clipped_dtm)
+            stored_dtm = open_store_layer(store_dir, site_name, layer)
+        return stored_dtm
+    
     # Returns the clipped lidar or uav dtm for plotting (this is not the same as
     # loading the clipped dtm saved to file in step above, tho contents are the same
     return clipped_dtm
@@ -249,7 +466,7 @@ def dtm_clip(site_name, site_dtm, clip_gdf, is_lidar):
 
 
 # Function to run REMMaker with UAV dtms
-def run_rem_maker(site_name, k=100):
+def run_rem_maker(site_name, k=100, store_dir=None):
     """Function to run the REMMaker tool on UAV DTMs
     
     Parameters
@@ -258,6 +475,9 @@ def run_rem_maker(site_name, k=100):
         Name of the site with existing DTM.
     k: int
         Number of interpolation points.
+    store_dir: str
+        Optional raster store directory to save the REM to. The REM is
+        then returned as a dataarray opened from the store.
         
     Returns
     ----------
@@ -295,12 +515,16 @@ def run_rem_maker(site_name, k=100):
 
     else:
         print('The UAV REMMaker REM already exists. Not running REMMaker')
+    
+    # Save the REM to the raster store and return the shared copy
+    if store_dir is not None:
+        return store_raster(store_dir, site_name, uav_rem_path)
 
 
 # In[7]:
 
 
-def run_rem_maker_lidar(site_name, k=100):
+def run_rem_maker_lidar(site_name, k=100, store_dir=None):
     """Run the REMMaker tool on LiDAR DTM
     
      Parameters
@@ -309,6 +533,9 @@ def run_rem_maker_lidar(site_name, k=100):
         Name of the site with existing DTM.
     k: int
         Number of interpolation points.
+    store_dir: str
+        Optional raster store directory to save the REM to. The REM is
+        then returned as a dataarray opened from the store.
         
     Returns
     ----------
@@ -346,11 +573,201 @@ def run_rem_maker_lidar(site_name, k=100):
 
     else:
         print('The LiDAR REMMaker REM already exists. Not running REMMaker')
+    
+    # Save the REM to the raster store and return the shared copy
+    if store_dir is not None:
+        return store_raster(store_dir, site_name, lidar_rem_path)
 
 
 # In[8]:
 
 
+# Functions to downsample elevation models block by block
+def _window_mode(windows):
+    """Returns the most common value of each row of windows, ignoring nans"""
+
+    # Sort each window so equal values form runs (nans are sorted last)
+    sorted_windows = np.sort(windows, axis=1)
+    positions = np.arange(sorted_windows.shape[1])
+    run_starts = np.ones(sorted_windows.shape, dtype=bool)
+    run_starts[:, 1:] = sorted_windows[:, 1:] != sorted_windows[:, :-1]
+
+    # Length of the run up to each position, zero for nan pixels
+    start_positions = np.maximum.accumulate(
+        np.where(run_starts, positions, 0), axis=1)
+    run_lengths = positions - start_positions + 1
+    run_lengths[np.isnan(sorted_windows)] = 0
+
+    # The first longest run ends on the smallest most common value
+    mode_positions = np.argmax(run_lengths, axis=1)
+    rows = np.arange(sorted_windows.shape[0])
+    mode = sorted_windows[rows, mode_positions]
+    mode[run_lengths[rows, mode_positions] == 0] = np.nan
+    return mode
+
+
+def _coarsen_block(block, ypix, xpix, method):
+    """Coarsens one block of rows and returns it with its nan min and max"""
+
+    if ypix == 1 and xpix == 1:
+        coarse = block
+    else:
+        # Reshape so each ypix by xpix window gets its own pair of axes
+        n_rows = block.shape[0] // ypix
+        n_cols = block.shape[1] // xpix
+        windows = block.reshape(n_rows, ypix, n_cols, xpix)
+
+        if method == 'mean':
+            valid_count = np.count_nonzero(~np.isnan(windows), axis=(1, 3))
+            window_sum = np.nansum(windows, axis=(1, 3))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                coarse = (window_sum / valid_count).astype(block.dtype)
+            coarse[valid_count == 0] = np.nan
+        # fmin/fmax skip nans and return nan only for all nan windows
+        elif method == 'min':
+            coarse = np.fmin.reduce(np.fmin.reduce(windows, axis=3), axis=1)
+        elif method == 'max':
+            coarse = np.fmax.reduce(np.fmax.reduce(windows, axis=3), axis=1)
+        elif method == 'mode':
+            windows = (windows.transpose(0, 2, 1, 3)
+                       .reshape(n_rows * n_cols, ypix * xpix))
+            coarse = _window_mode(windows).reshape(n_rows, n_cols)
+
+    if coarse.size == 0:
+        return coarse, np.nan, np.nan
+    return coarse, np.fmin.reduce(coarse, axis=None), np.fmax.reduce(
+        coarse, axis=None)
+
+
+def coarsen_array(values, ypix=1, xpix=1, method='mean', block_rows=256,
+                  n_workers=None):
+    """Downsamples a 2D array and returns it with its min and max
+
+    Parameters
+    ------------
+    values: array
+        A 2D array of elevation values, nan where masked.
+    ypix, xpix: int, int
+        The number of pixels in each window along y and x. Edge pixels
+        that do not fill a whole window are trimmed.
+    method: str
+        How to combine each window: 'mean', 'min', 'max' or 'mode'.
+        Nan pixels are ignored, and windows with only nans stay nan.
+    block_rows: int
+        The number of output rows coarsened by each worker at a time.
+    n_workers: int
+        The number of threads used over the row blocks (None = default).
+
+    Returns
+    -------
+    coarse: array
+        The downsampled array.
+    vmin, vmax: float, float
+        The nan min and max of the downsampled array.
+    """
+
+    if method not in ('mean', 'min', 'max', 'mode'):
+        raise ValueError('method must be mean, min, max or mode, '
+                         'not {}'.format(method))
+
+    # Keep float inputs as they are (no copy), only integers need nans
+    values = np.asarray(values)
+    if not np.issubdtype(values.dtype, np.floating):
+        values = values.astype('float64')
+
+    # Trim edge pixels that do not fill a whole window
+    n_rows = values.shape[0] // ypix
+    n_cols = values.shape[1] // xpix
+    values = values[:n_rows * ypix, :n_cols * xpix]
+
+    # Coarsen row blocks in parallel; numpy releases the GIL in the kernels
+    block_starts = range(0, max(n_rows, 1), block_rows)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        results = list(executor.map(
+            lambda start: _coarsen_block(
+                values[start * ypix:(start + block_rows) * ypix],
+                ypix, xpix, method),
+            block_starts))
+
+    # Without coarsening the blocks are views, so return the input itself
+    if ypix == 1 and xpix == 1:
+        coarse = values
+    else:
+        coarse = np.concatenate([result[0] for result in results], axis=0)
+    vmin = np.fmin.reduce([result[1] for result in results])
+    vmax = np.fmax.reduce([result[2] for result in results])
+    return coarse, vmin, vmax
+
+
+def coarsen_model(model, xpix=1, ypix=1, method='mean'):
+    """Downsamples an elevation model and returns it with its min and max
+
+    Parameters
+    ------------
+    model: dataarray
+        The dataarray to coarsen (single band).
+    xpix, ypix: int, int
+        The number of pixels to combine along x and y.
+    method: str
+        How to combine the pixels: 'mean', 'min', 'max' or 'mode'.
+
+    Returns
+    -------
+    coarse_model: dataarray
+        The coarsened dataarray, with window center coordinates.
+    vmin, vmax: float, float
+        The nan min and max of the coarsened dataarray.
+    """
+
+    model = model.squeeze()
+    coarse, vmin, vmax = coarsen_array(model.values, ypix=ypix, xpix=xpix,
+                                       method=method)
+
+    # Window center coordinates, the same as xarray coarsen with trim
+    n_rows, n_cols = coarse.shape
+    y = model.y.values[:n_rows * ypix].reshape(n_rows, ypix).mean(axis=1)
+    x = model.x.values[:n_cols * xpix].reshape(n_cols, xpix).mean(axis=1)
+    coarse_model = model.isel(y=slice(0, n_rows * ypix, ypix),
+                              x=slice(0, n_cols * xpix, xpix)).copy(data=coarse)
+    coarse_model = coarse_model.assign_coords(y=y, x=x)
+
+    # Recalculate the geotransform from the new coordinates for exports
+    if coarse_model.rio.crs is not None:
+        coarse_model = coarse_model.rio.write_transform(
+            coarse_model.rio.transform(recalc=True))
+    return coarse_model, vmin, vmax
+
+
+# Function to save a coarsened elevation model as a raster
+def save_coarsened_raster(model, raster_path, xpix, ypix, method='mean'):
+    """Coarsens an elevation model and saves it as a raster
+
+    Parameters
+    ------------
+    model: dataarray
+        The dataarray to coarsen and save.
+    raster_path: str
+        The path to the output raster (.tif).
+    xpix, ypix: int, int
+        The number of pixels to combine along x and y.
+    method: str
+        How to combine the pixels: 'mean', 'min', 'max' or 'mode'.
+
+    Returns
+    -------
+    raster_path: str
+        The path to the saved raster.
+    """
+
+    coarse_model, vmin, vmax = coarsen_model(model, xpix=xpix, ypix=ypix,
+                                             method=method)
+    coarse_model.rio.to_raster(raster_path)
+    return raster_path
+
+
+# In[9]:
+
+
 # Function to plot elevation models
 def plot_model(model, title, cbar_label, coarsen, fig, ax, cmap='terrain', xpix=1, ypix=1):
     """
@@ -386,13 +803,14 @@ def plot_model(model, title, cbar_label, coarsen, fig, ax, cmap='terrain', xpix=
     ax.set_xticks([])
     ax.set_yticks([])
 
-    # If true, coarsen
+    # If true, coarsen, otherwise only get the min and max
     if coarsen == True:
-        model = (model.coarsen(x=xpix, y=ypix, boundary='trim')
-                 .mean().squeeze())
+        model, vmin, vmax = coarsen_model(model, xpix=xpix, ypix=ypix)
+    else:
+        model, vmin, vmax = coarsen_model(model)
     # Plot DTM
     im=model.plot(ax=ax, add_colorbar=False, robust=True, cmap=cmap,
-                  vmin=np.nanmin(model), vmax=np.nanmax(model))
+                  vmin=vmin, vmax=vmax)
     
     # Add title and colorbar labe;
     ax.set_title(title, fontsize=18)
@@ -402,7 +820,7 @@ def plot_model(model, title, cbar_label, coarsen, fig, ax, cmap='terrain', xpix=
     ax.axis('off')
 
 
-# In[9]:
+# In[10]:
 
 
 def plot_hists(model, titles, main_title, color, fig, ax):
@@ -442,6 +860,173 @@ def plot_hists(model, titles, main_title, color, fig, ax):
     fig.supylabel('Frequency', fontsize=16)
 
 
+# In[11]:
+
+
+# Function to get the cell edges of a model for plotting
+def _model_extent(model, coarse_shape, xpix=1, ypix=1):
+    """Returns the (left, right, bottom, top) cell edges of a coarsened 
+    model for imshow"""
+    
+    model = model.squeeze()
+    x_res, y_res = model.rio.resolution()
+    left = model.x.values[0] - x_res / 2
+    top = model.y.values[0] - y_res / 2
+    right = left + coarse_shape[1] * xpix * x_res
+    bottom = top + coarse_shape[0] * ypix * y_res
+    return (left, right, bottom, top)
+
+
+# Function to draw pages of panels on one reused figure (runs in workers)
+def _render_pages(pages, out_paths, nrows, ncols, kind, cmap, cbar_label, 
+                  vmin, vmax, bins, figsize, panel_dir=None):
+    """Renders prepared pages to files, reusing the figure and artists
+    
+    Image panels are arrays, or names of .npy files in panel_dir which 
+    are memory mapped.
+    """
+    
+    # Build the layout and artists once, without pyplot (Agg canvas)
+    fig = Figure(figsize=figsize, layout='constrained')
+    axes = fig.subplots(nrows, ncols, squeeze=False).ravel()
+    artists = []
+    for ax in axes:
+        if kind == 'image':
+            artists.append(ax.imshow(np.full((2, 2), np.nan), 
+                                     cmap=cmap or 'terrain', 
+                                     vmin=vmin, vmax=vmax, aspect='auto',
+                                     interpolation='nearest'))
+            ax.axis('off')
+        else:
+            artists.append(ax.stairs(np.zeros(len(bins) - 1), bins, 
+                                     fill=True, color=cmap))
+    if kind == 'image':
+        cbar = fig.colorbar(artists[0], ax=axes.tolist())
+        cbar.set_label(cbar_label, fontsize=16)
+    else:
+        fig.supxlabel(cbar_label, fontsize=16)
+        fig.supylabel('Frequency', fontsize=16)
+    
+    # Swap the data of each page into the same artists
+    for page, out_path in zip(pages, out_paths):
+        fig.suptitle(page.get('main_title', ''), fontsize=20)
+        for i, (ax, artist) in enumerate(zip(axes, artists)):
+            if i >= len(page['panels']):
+                ax.set_visible(False)
+                continue
+            ax.set_visible(True)
+            values, extent = page['panels'][i]
+            if kind == 'image':
+                if isinstance(values, str):
+                    values = np.load(os.path.join(
+                        panel_dir, '{}.npy'.format(values)), mmap_mode='r')
+                artist.set_data(values)
+                artist.set_extent(extent)
+            else:
+                artist.set_data(values=values)
+                ax.relim()
+                ax.autoscale_view()
+            ax.set_title(page['titles'][i], fontsize=18)
+        fig.savefig(out_path)
+    
+    return list(out_paths)
+
+
+# Function to render many comparison figures in parallel
+def render_figure_batch(pages, out_paths, nrows, ncols, kind='image', 
+                        cmap=None, cbar_label='Elevation (m)', 
+                        xpix=1, ypix=1, bins=20, figsize=(16, 10), 
+                        n_workers=None):
+    """Renders pages of elevation model panels or histograms to files
+    
+    Panels are coarsened one at a time, keeping their dtype, and all 
+    panels share one color scale (or one set of histogram bins). Image 
+    panels are passed to the workers as memory mapped files. Each worker 
+    process builds the figure once and swaps each page into the same 
+    artists.
+    
+    Parameters
+    ------------
+    pages: list
+        List of dictionaries with 'models' (a list of dataarrays), 
+        'titles' (a list of panel titles) and optionally 'main_title'.
+    out_paths: list
+        The output file of each page (.png, .pdf or .jpg).
+    nrows, ncols: int, int
+        The panel layout of each page.
+    kind: str
+        'image' to plot the models or 'hist' to plot their histograms.
+    cmap: str
+        A matplotlib colormap ('image', default = terrain), or the bar 
+        color ('hist').
+    cbar_label: str
+        The label for the colorbar ('image') or the x axis ('hist').
+    xpix, ypix: int, int
+        The number of pixels to average before plotting.
+    bins: int
+        The number of histogram bins.
+    figsize: tuple
+        The size of the figure.
+    n_workers: int
+        The number of worker processes (None = default).
+        
+    Returns
+    -----------
+    out_paths: list
+        The paths to the rendered files.
+    """
+    
+    # Coarsen one model at a time and save image panels to a temporary 
+    # directory, so the workers memory map them instead of receiving 
+    # pickled copies (removed with everything in it, whatever fails)
+    with tempfile.TemporaryDirectory(prefix='panels_') as panel_dir:
+        render_pages = []
+        vmin, vmax = np.nan, np.nan
+        for page_number, page in enumerate(pages):
+            panels = []
+            for panel_number, model in enumerate(page['models']):
+                coarse, model_min, model_max = coarsen_array(
+                    model.squeeze().values, ypix=ypix, xpix=xpix)
+                vmin = np.fmin(vmin, model_min)
+                vmax = np.fmax(vmax, model_max)
+                if kind == 'image':
+                    layer = 'page_{}_panel_{}'.format(page_number, 
+                                                      panel_number)
+                    np.save(os.path.join(panel_dir, '{}.npy'.format(layer)), 
+                            coarse)
+                    panels.append((layer, _model_extent(model, coarse.shape, 
+                                                        xpix, ypix)))
+                else:
+                    panels.append((model, None))
+            render_pages.append({'panels': panels, 'titles': page['titles'],
+                                 'main_title': page.get('main_title', '')})
+    
+        # Histograms need the shared bins, so count them in a second pass
+        bin_edges = np.linspace(vmin, vmax, bins + 1)
+        if kind == 'hist':
+            for page in render_pages:
+                for i, (model, extent) in enumerate(page['panels']):
+                    coarse, _, _ = coarsen_array(model.squeeze().values, 
+                                                 ypix=ypix, xpix=xpix)
+                    counts, edges = np.histogram(coarse[~np.isnan(coarse)], 
+                                                 bins=bin_edges)
+                    page['panels'][i] = (counts, None)
+    
+        # Split the pages between the workers
+        n_workers = n_workers or os.cpu_count() or 1
+        n_workers = max(1, min(n_workers, len(render_pages)))
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(
+                _render_pages, render_pages[i::n_workers], 
+                out_paths[i::n_workers], nrows, ncols, kind, cmap, 
+                cbar_label, vmin, vmax, bin_edges, figsize, panel_dir)
+                for i in range(n_workers)]
+            for future in futures:
+                future.result()
+    
+    return list(out_paths)
+
+
 # Function to create flood map arrays - need to update pixel size/area
 def flood_map(threshold_values, lidar_rem):
     """Creates lists of floodmaps and inundated area
@@ -502,15 +1087,165 @@ def flood_map(threshold_values, lidar_rem):
     return flood_dictionary
 
 
+# Function to interpolate a coarse grid of errors along one axis
+def _interp_weights(size, spacing):
+    """Returns the number of coarse grid nodes, and for each of size 
+    pixels the lower node, the weight of the upper node and the scale 
+    that restores unit variance between the nodes"""
+    
+    n_coarse = int(np.ceil(size / spacing)) + 1
+    position = np.arange(size) / spacing
+    lower = np.floor(position).astype(int)
+    weight = (position - lower).astype('float32')
+    # Interpolating iid nodes lowers the variance to (1-w)^2 + w^2
+    scale = 1 / np.sqrt((1 - weight) ** 2 + weight ** 2)
+    return n_coarse, lower, weight, scale
+
+
+def _interp_axis(values, lower, weight, scale, axis):
+    """Linearly interpolates values along an axis at the given nodes"""
+    
+    shape = [1] * values.ndim
+    shape[axis] = -1
+    weight = weight.reshape(shape)
+    return ((np.take(values, lower, axis=axis) * (1 - weight)
+             + np.take(values, lower + 1, axis=axis) * weight)
+            * scale.reshape(shape))
+
+
+# Function to run the flood simulation on perturbed REMs
+def flood_map_uncertainty(threshold_values, rems, n_realizations=500,
+                          vertical_sd=0.1, correlated_sd=0.1, 
+                          correlation_pixels=50, pixel_area=None,
+                          confidence=0.9, batch_size=50, chunk_rows=64,
+                          seed=None):
+    """Creates confidence bands of inundated area from perturbed REMs
+    
+    Each realization picks one of the REMs (e.g. REMMaker runs with 
+    different k or interp_pts) and adds uncorrelated vertical noise plus 
+    a spatially correlated error field. Realizations are evaluated in 
+    batches over chunks of rows, so the full perturbed REMs are never 
+    held in memory.
+    
+    Parameters
+    ------------
+    threshold_values: list
+        A list of the water level thresholds.
+    rems: dataarray or list
+        The REM of a site, or a list of alternative REMs on the same grid.
+    n_realizations: int
+        The number of perturbed REMs to simulate.
+    vertical_sd: float
+        Standard deviation of the uncorrelated vertical error (m).
+    correlated_sd: float
+        Standard deviation of the spatially correlated error (m), the 
+        same at every pixel (the interpolated field is rescaled).
+    correlation_pixels: int
+        Spacing in pixels of the grid the correlated error is 
+        interpolated from.
+    pixel_area: float
+        Area of one pixel (default = from the raster resolution).
+    confidence: float
+        Width of the confidence band (0.9 = 5th to 95th percentile).
+    batch_size: int
+        The number of realizations evaluated together.
+    chunk_rows: int
+        The number of REM rows evaluated together.
+    seed: int
+        Seed for the random number generator.
+        
+    Returns
+    -----------
+    uncertainty_dictionary: dictionary
+        A dictionary with the thresholds, the inundated area of every 
+        realization, and the median and confidence band of the 
+        stage-area curve.
+    """
+    
+    if not isinstance(rems, (list, tuple)):
+        rems = [rems]
+    rems = [rem.squeeze() for rem in rems]
+    if pixel_area is None:
+        x_res, y_res = rems[0].rio.resolution()
+        pixel_area = abs(x_res * y_res)
+    
+    thresholds = np.sort(np.asarray(threshold_values, dtype='float32'))
+    n_thresholds = len(thresholds)
+    n_rows, n_cols = rems[0].shape
+    rng = np.random.default_rng(seed)
+    
+    # Interpolation matrices from the coarse error grid to the REM grid
+    n_coarse_y, y_lower, y_weight, y_scale = _interp_weights(
+        n_rows, correlation_pixels)
+    n_coarse_x, x_lower, x_weight, x_scale = _interp_weights(
+        n_cols, correlation_pixels)
+    
+    area_realizations = np.zeros((n_realizations, n_thresholds))
+    for batch_start in range(0, n_realizations, batch_size):
+        n_batch = min(batch_size, n_realizations - batch_start)
+        base_choice = rng.integers(len(rems), size=n_batch)
+        coarse_errors = rng.standard_normal(
+            (n_batch, n_coarse_y, n_coarse_x), 
+            dtype='float32') * correlated_sd
+        counts = np.zeros((n_batch, n_thresholds + 1), dtype='int64')
+        
+        for row_start in range(0, n_rows, chunk_rows):
+            rows = slice(row_start, row_start + chunk_rows)
+            bases = np.stack([np.asarray(rem[rows].values, dtype='float32')
+                              for rem in rems])
+            
+            # Correlated error of the chunk, interpolated one axis at a
+            # time from the coarse grid
+            correlated = _interp_axis(
+                _interp_axis(coarse_errors, y_lower[rows], y_weight[rows], 
+                             y_scale[rows], axis=1),
+                x_lower, x_weight, x_scale, axis=2)
+            
+            # Perturbed REM chunk for every realization in the batch
+            perturbed = (bases[base_choice] + correlated
+                         + rng.standard_normal(
+                             (n_batch,) + bases.shape[1:], 
+                             dtype='float32') * vertical_sd)
+            
+            # Count pixels by the first threshold they are inundated at;
+            # nodata pixels land in the last bin and are not counted
+            first_stage = np.searchsorted(thresholds, perturbed.reshape(
+                n_batch, -1), side='left')
+            first_stage += (np.arange(n_batch) * (n_thresholds + 1))[:, None]
+            counts += np.bincount(first_stage.ravel(), 
+                                  minlength=n_batch * (n_thresholds + 1)
+                                  ).reshape(n_batch, n_thresholds + 1)
+        
+        area_realizations[batch_start:batch_start + n_batch] = (
+            np.cumsum(counts[:, :n_thresholds], axis=1) * pixel_area)
+    
+    tail = (1 - confidence) / 2 * 100
+    uncertainty_dictionary = {
+        'threshold_values': thresholds,
+        'area_realizations': area_realizations,
+        'area_median': np.percentile(area_realizations, 50, axis=0),
+        'area_lower': np.percentile(area_realizations, tail, axis=0),
+        'area_upper': np.percentile(area_realizations, 100 - tail, axis=0)}
+    
+    return uncertainty_dictionary
+
+
 # ADefine plots for simulation
-def plot_floodmap(plot_da, site, vmin, vmax):
+def plot_floodmap(plot_da, site, vmin=None, vmax=None, show=True):
     ###
-    # Plots the floodmap at each threshold
+    # Plots the floodmap at each threshold. Pass the same vmin/vmax for 
+    # every threshold to share color limits, and show=False to skip 
+    # plt.show() (e.g. when saving many thresholds, see 
+    # render_figure_batch)
     ###
+    if vmin is None or vmax is None:
+        plot_da, plot_min, plot_max = coarsen_model(plot_da)
+        vmin = plot_min if vmin is None else vmin
+        vmax = plot_max if vmax is None else vmax
     fig, ax = plt.subplots(1, 1, figsize=(10, 6))
     im = plot_da.plot(ax=ax, add_colorbar=False, 
                       cmap='viridis', robust=True, 
-                      vmin=np.nanmin(plot_da), vmax=np.nanmax(plot_da))
+                      vmin=vmin, vmax=vmax)
     cbar = fig.colorbar(im)
     cbar.set_label('Relative Elevation (m)', fontsize=16)
     ax.set_title('Inundation at {} over increasing water levels'.format(site),
@@ -523,7 +1258,9 @@ def plot_floodmap(plot_da, site, vmin, vmax):
     ax.set_yticks([])
     ax.legend('off')
     ax.axis('off')
-    plt.show()
+    if show:
+        plt.show()
+    return fig, ax
     
 # Function to sort image files numerically
 def numericalSort(value):
@@ -555,18 +1292,16 @@ def save_frames(site_name, site_dictionary):
     if not os.path.exists(gif_dir):
         os.makedirs(gif_dir)
 
-        for i, threshold_da in enumerate(site_dictionary['threshold_lidar_das']):
-            fig, ax = plt.subplots(1, 1, figsize=(10, 6))
-            plot_model(model=threshold_da,
-                       title='Inundation at {} with increasing water levels'.format(site_name),
-                       cbar_label='Relative Elevation (m)',
-                       coarsen=False,
-                       fig=fig, ax=ax,
-                       cmap='viridis')
-
-            # Save plot frames to gif dir
-            fig_path=os.path.join(gif_dir, '{site}_step_{i}.jpg'.format(site=site_name, i=i))
-            fig.savefig(fig_path)
+        # Render the plot frames to gif dir on one reused figure
+        threshold_das = site_dictionary['threshold_lidar_das']
+        title = 'Inundation at {} with increasing water levels'.format(site_name)
+        render_figure_batch(
+            pages=[{'models': [threshold_da], 'titles': [title]}
+                   for threshold_da in threshold_das],
+            out_paths=[os.path.join(gif_dir, '{site}_step_{i}.jpg'.format(site=site_name, i=i))
+                       for i in range(len(threshold_das))],
+            nrows=1, ncols=1, cmap='viridis',
+            cbar_label='Relative Elevation (m)', figsize=(10, 6))
     
     # Create gif of the plot frames
     for image in sorted(glob.glob(gif_dir + '/*.jpg'), key=numericalSort):
@@ -577,4 +1312,126 @@ def save_frames(site_name, site_dictionary):
                    append_images=frames[1:], save_all=True, duration=300, loop=0)
     # Path to the gif file
     gif_path = os.path.join('{}_flood.gif'.format(site_name))
-    return gif_path
\ No newline at end of file
+    return gif_path
+
+# Function to simplify polygons that share edges without shapely 2.1
+def _simplify_shared_edges(polygons, tolerance, n_workers=None):
+    """Simplifies non-overlapping polygons along their shared edges
+    
+    A topojson-style fallback for shapely.coverage_simplify (shapely < 
+    2.1): the boundaries are noded into edges, each edge is simplified 
+    once (in parallel) with its end nodes fixed, and the faces rebuilt 
+    from the simplified edges are given back to the polygon that 
+    contained them.
+    """
+    
+    edges = linemerge(unary_union([polygon.boundary 
+                                   for polygon in polygons]))
+    edges = list(getattr(edges, 'geoms', [edges]))
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        edges = list(executor.map(
+            lambda edge: edge.simplify(tolerance, preserve_topology=True),
+            edges))
+    
+    prepared = [prep(polygon) for polygon in polygons]
+    faces = [[] for polygon in polygons]
+    for face in polygonize(edges):
+        point = face.representative_point()
+        for i, polygon in enumerate(prepared):
+            if polygon.contains(point):
+                faces[i].append(face)
+                break
+    return [unary_union(polygon_faces) for polygon_faces in faces]
+
+
+# Function to export the flood extents at each threshold as polygons
+def save_flood_polygons(site_name, threshold_values, rem, out_path,
+                        tolerance=0, n_workers=None):
+    """Saves the inundated area at each threshold as polygons
+    
+    Parameters
+    -------------
+    site_name: str
+        Name of the site.
+    threshold_values: list
+        A list of the water level thresholds.
+    rem: dataarray
+        Dataarray of the REM for a site.
+    out_path: str
+        Path to the output file, a GeoPackage (.gpkg) or GeoParquet 
+        (.parquet).
+    tolerance: float
+        Simplification tolerance in CRS units (0 = do not simplify). 
+        Uses shapely.coverage_simplify (shapely >= 2.1, GEOS >= 3.12), 
+        or an approximate shared edge simplification with older shapely.
+    n_workers: int
+        The number of threads used to dissolve, simplify and union.
+        
+    Returns
+    ------------
+    extents_gdf: geodataframe
+        A geodataframe with the inundated area at each threshold.
+    """
+    
+    rem = rem.squeeze()
+    thresholds = np.sort(np.asarray(threshold_values, dtype=float))
+    
+    # Index of the first threshold each pixel is inundated at (rem <= 
+    # threshold, as in flood_map); nodata and dry pixels are masked out
+    first_stage = (np.searchsorted(thresholds, rem.values, side='left')
+                   .astype('int32'))
+    band_polygons = [(int(stage), shape(geom)) for geom, stage 
+                     in features.shapes(first_stage, 
+                                        mask=first_stage < len(thresholds),
+                                        transform=rem.rio.transform())]
+    
+    # Group the polygons by band once, then dissolve each band
+    band_groups = [[] for threshold in thresholds]
+    for band, polygon in band_polygons:
+        band_groups[band].append(polygon)
+    
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        bands = list(executor.map(unary_union, band_groups))
+    
+    # Simplify the bands together as one coverage so neighbouring bands 
+    # keep their shared edges (no gaps or overlaps)
+    if tolerance > 0:
+        filled = [i for i, band in enumerate(bands) if not band.is_empty]
+        filled_bands = [bands[i] for i in filled]
+        if hasattr(shapely, 'coverage_simplify'):
+            simplified = shapely.coverage_simplify(filled_bands, tolerance)
+        else:
+            simplified = _simplify_shared_edges(filled_bands, tolerance, 
+                                                n_workers)
+        for i, band in zip(filled, simplified):
+            bands[i] = band
+    
+    # Each extent is the union of the bands up to its threshold, so the 
+    # extents stay nested. The running unions are built as a parallel 
+    # prefix scan (log2 of the number of thresholds rounds of unions)
+    extents = list(bands)
+    step = 1
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        while step < len(extents):
+            extents = extents[:step] + list(executor.map(
+                lambda i: extents[i - step].union(extents[i]),
+                range(step, len(extents))))
+            step *= 2
+    
+    extents_gdf = gpd.GeoDataFrame({'site_name': site_name,
+                                    'threshold': thresholds},
+                                   geometry=extents, crs=rem.rio.crs)
+    extents_gdf['area'] = extents_gdf.area
+    bands_gdf = gpd.GeoDataFrame({'site_name': site_name,
+                                  'threshold': thresholds},
+                                 geometry=bands, crs=rem.rio.crs)
+    bands_gdf['area'] = bands_gdf.area
+    
+    # Save the extents, plus the bands as a second GeoPackage layer
+    if out_path.endswith('.parquet'):
+        extents_gdf.to_parquet(out_path)
+    else:
+        extents_gdf.to_file(out_path, driver='GPKG', layer='flood_extents')
+        bands_gdf.to_file(out_path, driver='GPKG', layer='flood_bands')
+    
+    return extents_gdf
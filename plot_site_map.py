@@ -48,6 +48,14 @@ wbd_10_url = (
 stream_url = ("https://geo.colorado.edu/apps/geolibrary/"
               "datasets/STREAMSx4.zip")
 
+# Optional stand-in host for the downloads (e.g. a local test server),
+# which serves the same files by file name
+data_host = os.environ.get('ST_VRAIN_DATA_HOST')
+if data_host:
+    sites_url = data_host + '/UAV_gps_coords.csv'
+    wbd_10_url = data_host + '/WBD_10_HU2_Shape.zip'
+    stream_url = data_host + '/STREAMSx4.zip'
+
 
 # In[4]:
 
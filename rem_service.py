@@ -0,0 +1,611 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[1]:
+
+
+# Imports
+import argparse
+import asyncio
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import functools
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import os
+import pathlib
+import re
+import shutil
+import tempfile
+import threading
+import urllib.parse
+
+import matplotlib.image as mpimg
+from PIL import Image
+import rioxarray as rxr
+
+import flood_index
+import load_model
+
+
+# In[2]:
+
+
+# Default hosts of the site data (zenodo and the github release)
+zenodo_host = 'https://zenodo.org'
+github_host = 'https://github.com'
+
+# Default working directory, the one get_boundary_gdf extracts to
+default_work_dir = os.path.join(
+    pathlib.Path.home(), 'st-vrain-rem-wkdir', 'data')
+
+default_thresholds = '0.5,1,1.5,2,2.5,3'
+
+# The study sites with data on the hosts
+site_names = ['applevalley', 'hallmeadows', 'highway93', 'legacy',
+              'vanvleet']
+
+
+# Function to build the download urls of a site
+def get_data_urls(site_name, data_host=None):
+    """Creates the download urls of a site's data
+
+    Parameters
+    ------------
+    site_name: str
+        The name of the site.
+    data_host: str
+        Optional stand-in host for all downloads (e.g. a local server).
+
+    Returns
+    ------------
+    data_urls: dictionary
+        A dictionary with the uav rem, uav dtm and lidar urls.
+    """
+
+    zenodo = data_host or zenodo_host
+    github = data_host or github_host
+    return {
+        'uav_rem': ('{}/record/8218054/files/{}_uav_rem.tif?download=1'
+                    .format(zenodo, site_name)),
+        'uav_dtm': ('{}/record/8218054/files/{}_uav_dtm.tif?download=1'
+                    .format(zenodo, site_name)),
+        'lidar': ('{}/lechipman/watershed-project/releases/download/'
+                  'v2.0.0/{}_lidar.zip'.format(github, site_name))}
+
+
+# In[3]:
+
+
+# Functions run in the worker processes. Each one starts in the working
+# directory because the pipeline functions use relative paths.
+def _job_rem(work_dir, data_host, boundary_url, site_name, source):
+    """Loads or creates the REM of a site and returns its summary"""
+
+    os.chdir(work_dir)
+    data_urls = get_data_urls(site_name, data_host)
+
+    # Precomputed UAV REM (as used in the notebook)
+    if source == 'uav':
+        rem_path = os.path.join(site_name, '{}_rem.tif'.format(site_name))
+        rem = load_model.load_dtm(site_name=site_name,
+                                  data_url=data_urls['uav_rem'],
+                                  file_name='{}_rem.tif'.format(site_name))
+        if rem is None:
+            raise FileNotFoundError('no uav rem for {}'.format(site_name))
+
+    # REMMaker REM from the clipped UAV or LiDAR DTM
+    else:
+        is_lidar = source == 'lidar'
+        if is_lidar:
+            dtm = load_model.load_dtm(
+                site_name=site_name, data_url=data_urls['lidar'],
+                file_name='{}_lidar.zip'.format(site_name))
+        else:
+            dtm = load_model.load_dtm(
+                site_name=site_name, data_url=data_urls['uav_dtm'],
+                file_name='{}_dtm.tif'.format(site_name))
+        if dtm is None:
+            raise FileNotFoundError('no {} dtm for {}'.format(source,
+                                                               site_name))
+        clip_gdf = load_model.get_boundary_gdf(boundary_url, site_name,
+                                               work_dir)
+        if clip_gdf is None:
+            raise FileNotFoundError('no boundary for {}'.format(site_name))
+        load_model.dtm_clip(site_name, dtm, clip_gdf, is_lidar)
+        if is_lidar:
+            load_model.run_rem_maker_lidar(site_name)
+            rem_path = os.path.join(
+                site_name, 'remmaker_lidar',
+                '{}_lidar_clipped_dtm_REM.tif'.format(site_name))
+        else:
+            load_model.run_rem_maker(site_name)
+            rem_path = os.path.join(
+                site_name, 'remmaker',
+                '{}_clipped_dtm_REM.tif'.format(site_name))
+        rem = rxr.open_rasterio(rem_path, masked=True)
+
+    rem, vmin, vmax = load_model.coarsen_model(rem)
+    return {'site_name': site_name,
+            'source': source,
+            'rem_path': os.path.abspath(rem_path),
+            'shape': list(rem.shape),
+            'crs': rem.rio.crs.to_string(),
+            'vmin': float(vmin),
+            'vmax': float(vmax)}
+
+
+def _job_flood_curve(work_dir, rem_path, thresholds):
+    """Returns the inundated area at each threshold from the REM index
+
+    Unlike flood_map (which uses the LiDAR pixel area and counts nodata
+    pixels), the index counts valid pixels only, with the pixel area
+    from the raster resolution.
+    """
+
+    os.chdir(work_dir)
+    index_dir = os.path.splitext(rem_path)[0] + '_index'
+    if not os.path.exists(os.path.join(index_dir, 'metadata.json')):
+        # Build in a temporary directory so concurrent jobs never read a
+        # half written index
+        build_dir = tempfile.mkdtemp(dir=os.path.dirname(rem_path))
+        flood_index.build_rem_index(rem_path, build_dir)
+        try:
+            os.rename(build_dir, index_dir)
+        except OSError:
+            shutil.rmtree(build_dir, ignore_errors=True)
+    rem_index = flood_index.load_rem_index(index_dir)
+    return {'threshold_values': list(thresholds),
+            'area_list': [flood_index.flooded_area(rem_index, threshold)
+                          for threshold in thresholds]}
+
+
+def _frame_page(site_name, rem, threshold, xpix, ypix):
+    """Returns the render page of the flood frame at one threshold"""
+
+    threshold_da = rem.where(rem > threshold)
+    values, _, _ = load_model.coarsen_array(threshold_da.values, ypix=ypix,
+                                            xpix=xpix)
+    extent = load_model._model_extent(rem, values.shape, xpix, ypix)
+    return {'panels': [(values, extent)],
+            'titles': ['Inundation at {} with water level {} m'
+                       .format(site_name, threshold)]}
+
+
+def _job_frame(work_dir, site_name, rem_path, threshold, vmin, vmax,
+               xpix, ypix):
+    """Renders the flood frame at one threshold and returns the png"""
+
+    os.chdir(work_dir)
+    rem = rxr.open_rasterio(rem_path, masked=True).squeeze()
+    frame = io.BytesIO()
+    load_model._render_pages([_frame_page(site_name, rem, threshold, xpix,
+                                          ypix)],
+                             [frame], 1, 1, 'image', 'viridis',
+                             'Relative Elevation (m)', vmin, vmax, None,
+                             (10, 6))
+    return frame.getvalue()
+
+
+def _job_tile(work_dir, rem_path, row, col, tile_size, vmin, vmax):
+    """Renders one tile of the REM and returns the png"""
+
+    os.chdir(work_dir)
+    rem = rxr.open_rasterio(rem_path, masked=True).squeeze()
+    tile = rem.isel(y=slice(row * tile_size, (row + 1) * tile_size),
+                    x=slice(col * tile_size, (col + 1) * tile_size))
+    image = io.BytesIO()
+    mpimg.imsave(image, tile.values, cmap='terrain', vmin=vmin, vmax=vmax,
+                 format='png')
+    return image.getvalue()
+
+
+def _job_gif(work_dir, site_name, rem_path, thresholds, vmin, vmax):
+    """Renders the flood frames and returns them as a gif
+
+    The frames and the gif are built in memory rather than with
+    save_frames, so requests with different thresholds do not share (or
+    race on) the same frame directory.
+    """
+
+    os.chdir(work_dir)
+    rem = rxr.open_rasterio(rem_path, masked=True).squeeze()
+    frames = [io.BytesIO() for threshold in thresholds]
+    pages = (_frame_page(site_name, rem, threshold, 1, 1)
+             for threshold in thresholds)
+    load_model._render_pages(pages, frames, 1, 1, 'image', 'viridis',
+                             'Relative Elevation (m)', vmin, vmax, None,
+                             (10, 6))
+
+    images = [Image.open(frame) for frame in frames]
+    gif = io.BytesIO()
+    images[0].save(gif, format='GIF', append_images=images[1:],
+                   save_all=True, duration=300, loop=0)
+    return gif.getvalue()
+
+
+def _job_site_map(work_dir, data_host):
+    """Returns the folium map of the study sites as html"""
+
+    # plot_site_map downloads its data when imported
+    if data_host:
+        os.environ['ST_VRAIN_DATA_HOST'] = data_host
+    os.chdir(work_dir)
+    import plot_site_map
+    return plot_site_map.plot_sites_folium().get_root().render()
+
+
+# In[4]:
+
+
+# Function to serve local files in place of the remote data hosts
+def run_standin_host(data_dir, port=8001):
+    """Serves files from a local directory in place of the data hosts
+
+    Files are found by the last part of the requested path, so the same
+    urls as zenodo and the github release work (query strings are
+    ignored).
+
+    Parameters
+    ------------
+    data_dir: str
+        The directory with the site files (e.g. hallmeadows_uav_rem.tif).
+    port: int
+        The port to serve on.
+
+    Returns
+    ------------
+    data_host: str
+        The url of the stand-in host.
+    """
+
+    class StandinHandler(SimpleHTTPRequestHandler):
+        def translate_path(self, path):
+            file_name = urllib.parse.urlsplit(path).path.rsplit('/', 1)[-1]
+            return os.path.join(data_dir, file_name)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), StandinHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}'.format(port)
+
+
+# In[5]:
+
+
+class ServiceError(Exception):
+    """Error returned to the client with an http status"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class RemService:
+    """Asyncio http service for the REM and flood simulation pipeline
+
+    CPU work runs in a process pool. REMMaker jobs run one at a time in
+    their own process, since they share shapefiles.zip and the OSM
+    cache. Results are kept in a least recently used cache of at most
+    cache_bytes, and concurrent identical requests share one running job.
+
+    Parameters
+    ------------
+    work_dir: str
+        The directory the pipeline downloads and writes files in.
+    data_host: str
+        Optional stand-in host for all downloads.
+    boundary_url: str
+        Url of the boundary shapefiles zipfile (for REMMaker REMs).
+    n_workers: int
+        The number of worker processes.
+    cache_bytes: int
+        The maximum size of the cached results.
+    sites: list
+        The site names the service accepts (default = site_names).
+    """
+
+    routes = [
+        (re.compile(r'^/sites/(?P<site>\w+)/rem$'), 'rem'),
+        (re.compile(r'^/sites/(?P<site>\w+)/rem\.tif$'), 'rem_tif'),
+        (re.compile(r'^/sites/(?P<site>\w+)/flood-curve$'), 'flood_curve'),
+        (re.compile(r'^/sites/(?P<site>\w+)/frames$'), 'frames'),
+        (re.compile(r'^/sites/(?P<site>\w+)/tiles$'), 'tiles'),
+        (re.compile(r'^/sites/(?P<site>\w+)/flood\.gif$'), 'gif'),
+        (re.compile(r'^/map$'), 'site_map')]
+
+    def __init__(self, work_dir=default_work_dir, data_host=None,
+                 boundary_url=None, n_workers=None,
+                 cache_bytes=256 * 1024 ** 2, sites=None):
+        if not os.path.exists(work_dir):
+            print('{} does not exist. Creating...'.format(work_dir))
+            os.makedirs(work_dir)
+        self.work_dir = os.path.abspath(work_dir)
+        self.data_host = data_host
+        self.boundary_url = boundary_url
+        self.executor = ProcessPoolExecutor(max_workers=n_workers)
+        self.remmaker_executor = ProcessPoolExecutor(max_workers=1)
+        self.results = collections.OrderedDict()
+        self.cache_bytes = cache_bytes
+        self.cached_bytes = 0
+        self.pending = {}
+        self.sites = set(sites or site_names)
+
+    def cache_result(self, key, result):
+        """Caches a result, dropping the least recently used ones"""
+
+        if isinstance(result, (bytes, str)):
+            size = len(result)
+        else:
+            size = len(json.dumps(result))
+        if key in self.results or size > self.cache_bytes:
+            return
+        self.results[key] = (result, size)
+        self.cached_bytes += size
+        while self.cached_bytes > self.cache_bytes:
+            old_result, old_size = self.results.popitem(last=False)[1]
+            self.cached_bytes -= old_size
+
+    async def run_job(self, job, *args, executor=None):
+        """Runs a job once, returning cached or in progress results"""
+
+        key = (job.__name__,) + args
+        if key in self.results:
+            self.results.move_to_end(key)
+            return self.results[key][0]
+        if key not in self.pending:
+            loop = asyncio.get_running_loop()
+            self.pending[key] = loop.run_in_executor(
+                executor or self.executor,
+                functools.partial(job, self.work_dir, *args))
+        try:
+            # Shield so a client disconnecting does not cancel the job
+            result = await asyncio.shield(self.pending[key])
+        finally:
+            if key in self.pending and self.pending[key].done():
+                del self.pending[key]
+        self.cache_result(key, result)
+        return result
+
+    async def get_rem(self, site_name, query):
+        source = query.get('source', 'uav')
+        if source not in ('uav', 'remmaker', 'lidar'):
+            raise ServiceError(400, 'source must be uav, remmaker or lidar')
+        if source != 'uav' and self.boundary_url is None:
+            raise ServiceError(400, 'the service has no boundary url')
+        executor = self.remmaker_executor if source != 'uav' else None
+        return await self.run_job(_job_rem, self.data_host,
+                                  self.boundary_url, site_name, source,
+                                  executor=executor)
+
+    # Request handlers, each returns (content type, body or async parts)
+    async def rem(self, site_name, query):
+        return 'application/json', json.dumps(
+            await self.get_rem(site_name, query)).encode()
+
+    async def rem_tif(self, site_name, query):
+        rem_info = await self.get_rem(site_name, query)
+        loop = asyncio.get_running_loop()
+        body = await loop.run_in_executor(
+            None, pathlib.Path(rem_info['rem_path']).read_bytes)
+        return 'image/tiff', body
+
+    async def flood_curve(self, site_name, query):
+        rem_info = await self.get_rem(site_name, query)
+        curve = await self.run_job(_job_flood_curve, rem_info['rem_path'],
+                                   parse_thresholds(query))
+        return 'application/json', json.dumps(curve).encode()
+
+    async def frames(self, site_name, query):
+        rem_info = await self.get_rem(site_name, query)
+        xpix = parse_positive_int(query, 'xpix', 1)
+        ypix = parse_positive_int(query, 'ypix', 1)
+        jobs = [({'X-Threshold': threshold},
+                 self.run_job(_job_frame, site_name, rem_info['rem_path'],
+                              threshold, rem_info['vmin'], rem_info['vmax'],
+                              xpix, ypix))
+                for threshold in parse_thresholds(query)]
+        return 'image/png', stream_parts(jobs)
+
+    async def tiles(self, site_name, query):
+        rem_info = await self.get_rem(site_name, query)
+        tile_size = parse_positive_int(query, 'size', 512)
+        n_rows, n_cols = rem_info['shape']
+        jobs = [({'X-Tile-Row': row, 'X-Tile-Col': col},
+                 self.run_job(_job_tile, rem_info['rem_path'], row, col,
+                              tile_size, rem_info['vmin'], rem_info['vmax']))
+                for row in range(-(-n_rows // tile_size))
+                for col in range(-(-n_cols // tile_size))]
+        return 'image/png', stream_parts(jobs)
+
+    async def gif(self, site_name, query):
+        rem_info = await self.get_rem(site_name, query)
+        return 'image/gif', await self.run_job(
+            _job_gif, site_name, rem_info['rem_path'],
+            parse_thresholds(query), rem_info['vmin'], rem_info['vmax'])
+
+    async def site_map(self, site_name, query):
+        return 'text/html', (await self.run_job(
+            _job_site_map, self.data_host)).encode()
+
+    async def handle(self, reader, writer):
+        """Handles one http request per connection"""
+
+        try:
+            request_line = (await reader.readline()).decode('latin-1')
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            try:
+                method, target = request_line.split()[:2]
+            except ValueError:
+                raise ServiceError(400, 'bad request')
+            if method != 'GET':
+                raise ServiceError(405, 'only GET is supported')
+            url = urllib.parse.urlsplit(target)
+            query = dict(urllib.parse.parse_qsl(url.query))
+
+            for pattern, handler_name in self.routes:
+                match = pattern.match(url.path)
+                if match:
+                    site_name = match.groupdict().get('site')
+                    # Unknown sites never reach the pipeline (or the hosts)
+                    if site_name is not None and site_name not in self.sites:
+                        raise ServiceError(
+                            404, 'unknown site {}'.format(site_name))
+                    handler = getattr(self, handler_name)
+                    content_type, body = await handler(site_name, query)
+                    break
+            else:
+                raise ServiceError(404, 'not found')
+
+            if isinstance(body, bytes):
+                await write_response(writer, 200, content_type, body)
+            else:
+                await write_stream(writer, content_type, body)
+        except ServiceError as error:
+            await write_response(writer, error.status, 'application/json',
+                                 json.dumps({'error': str(error)}).encode())
+        except ConnectionError:
+            pass
+        except Exception as error:
+            await write_response(writer, 500, 'application/json',
+                                 json.dumps({'error': repr(error)}).encode())
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8000):
+        """Serves the service until cancelled"""
+
+        server = await asyncio.start_server(self.handle, host, port)
+        print('Serving on http://{}:{}'.format(host, port))
+        async with server:
+            await server.serve_forever()
+
+
+# In[6]:
+
+
+# Functions to parse requests and write responses
+def parse_thresholds(query):
+    """Returns the sorted water level thresholds of a request"""
+
+    try:
+        return tuple(sorted(float(threshold) for threshold
+                            in query.get('thresholds',
+                                         default_thresholds).split(',')))
+    except ValueError:
+        raise ServiceError(400, 'thresholds must be numbers')
+
+
+def parse_positive_int(query, name, default):
+    """Returns a positive integer parameter (e.g. xpix) of a request"""
+
+    try:
+        value = int(query.get(name, default))
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise ServiceError(400, '{} must be a positive integer'.format(name))
+    return value
+
+
+async def stream_parts(jobs):
+    """Yields (headers, body) of each (headers, job) as the jobs finish"""
+
+    async def with_headers(headers, job):
+        return headers, await job
+
+    for part in asyncio.as_completed([with_headers(headers, job)
+                                      for headers, job in jobs]):
+        yield await part
+
+
+status_text = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+               405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+async def write_response(writer, status, content_type, body):
+    """Writes a complete http response"""
+
+    writer.write(('HTTP/1.1 {} {}\r\nContent-Type: {}\r\n'
+                  'Content-Length: {}\r\nConnection: close\r\n\r\n'
+                  .format(status, status_text[status], content_type,
+                          len(body))).encode('latin-1') + body)
+    await writer.drain()
+
+
+async def write_stream(writer, content_type, parts, boundary='part'):
+    """Writes a chunked multipart response part by part as parts finish
+
+    The 200 headers are sent before the parts, so a failing job is sent
+    as a json error part and the stream is then closed normally.
+    """
+
+    async def write_chunk(chunk):
+        writer.write('{:x}\r\n'.format(len(chunk)).encode() + chunk + b'\r\n')
+        await writer.drain()
+
+    def part(part_type, headers, body):
+        part_headers = ''.join('{}: {}\r\n'.format(name, value)
+                               for name, value in headers.items())
+        return ('--{}\r\nContent-Type: {}\r\n{}\r\n'
+                .format(boundary, part_type, part_headers)
+                .encode('latin-1') + body + b'\r\n')
+
+    writer.write(('HTTP/1.1 200 OK\r\n'
+                  'Content-Type: multipart/mixed; boundary={}\r\n'
+                  'Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n'
+                  .format(boundary)).encode('latin-1'))
+    try:
+        async for headers, body in parts:
+            await write_chunk(part(content_type, headers, body))
+    except ConnectionError:
+        raise
+    except Exception as error:
+        await write_chunk(part('application/json', {'X-Error': 'true'},
+                               json.dumps({'error': repr(error)}).encode()))
+    await write_chunk('--{}--\r\n'.format(boundary).encode())
+    writer.write(b'0\r\n\r\n')
+    await writer.drain()
+
+
+# In[7]:
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve the St. Vrain REM and flood simulation pipeline')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--work-dir', default=default_work_dir)
+    parser.add_argument('--cache-mb', type=int, default=256,
+                        help='Maximum size of the cached results')
+    parser.add_argument('--data-host', default=None,
+                        help='Stand-in url for the remote data hosts')
+    parser.add_argument('--standin-dir', default=None,
+                        help='Serve this directory as the data host')
+    parser.add_argument('--boundary-url', default=None,
+                        help='Url of the boundary shapefiles zipfile')
+    parser.add_argument('--sites', default=','.join(site_names),
+                        help='Comma separated site names to serve')
+    args = parser.parse_args()
+
+    data_host = args.data_host
+    if args.standin_dir:
+        data_host = run_standin_host(os.path.abspath(args.standin_dir))
+        print('Serving {} as the data host on {}'.format(args.standin_dir,
+                                                         data_host))
+    service = RemService(work_dir=args.work_dir, data_host=data_host,
+                         boundary_url=args.boundary_url,
+                         n_workers=args.workers,
+                         cache_bytes=args.cache_mb * 1024 ** 2,
+                         sites=args.sites.split(','))
+    asyncio.run(service.serve(args.host, args.port))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In[1]:
+
+
+# Imports
+import argparse
+import asyncio
+import random
+import time
+import urllib.parse
+
+
+# In[2]:
+
+
+# Endpoints whose results depend on the thresholds of the request
+threshold_endpoints = ['flood-curve', 'frames', 'flood.gif']
+
+
+# Function to send one GET request and read the whole response
+async def timed_get(url):
+    """Sends a GET request and returns (status, latency in seconds)
+
+    Streamed (multipart) responses that end with an error part count as
+    a 500, since their status line is sent before the parts run.
+    """
+
+    parts = urllib.parse.urlsplit(url)
+    target = parts.path + ('?' + parts.query if parts.query else '')
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection(parts.hostname,
+                                                   parts.port or 80)
+    writer.write('GET {} HTTP/1.1\r\nHost: {}\r\nConnection: close\r\n\r\n'
+                 .format(target, parts.netloc).encode('latin-1'))
+    await writer.drain()
+
+    # The service closes the connection after each response
+    response = await reader.read()
+    writer.close()
+    latency = time.perf_counter() - start
+    status = int(response.split(b' ', 2)[1]) if response else 0
+    if b'\r\nX-Error: true\r\n' in response:
+        status = 500
+    return status, latency
+
+
+# Function to measure the throughput and latency of the service
+async def load_test(urls, n_requests, concurrency):
+    """Sends requests to the urls and returns the throughput and latencies
+
+    Parameters
+    ------------
+    urls: list
+        The urls to request, in turn.
+    n_requests: int
+        The total number of requests.
+    concurrency: int
+        The number of requests in flight at the same time.
+
+    Returns
+    ------------
+    results: dictionary
+        A dictionary with the throughput (successful requests per
+        second), the p50 and p99 latencies of the successful requests
+        (seconds) and the number of errors (failed or non-200 requests).
+    """
+
+    latencies = []
+    errors = 0
+    next_request = 0
+
+    async def worker():
+        nonlocal errors, next_request
+        while next_request < n_requests:
+            url = urls[next_request % len(urls)]
+            next_request += 1
+            try:
+                status, latency = await timed_get(url)
+            except OSError:
+                errors += 1
+                continue
+            # Only successful requests count toward throughput and latency
+            if status == 200:
+                latencies.append(latency)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for i in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    if not latencies:
+        return {'throughput': 0.0, 'p50': None, 'p99': None,
+                'errors': errors}
+    return {'throughput': len(latencies) / elapsed,
+            'p50': latencies[int(0.50 * (len(latencies) - 1))],
+            'p99': latencies[int(0.99 * (len(latencies) - 1))],
+            'errors': errors}
+
+
+# Function to create urls the service has not seen before
+def uncached_urls(base_urls, n_requests):
+    """Returns n_requests urls, each with its own random thresholds
+
+    Parameters
+    ------------
+    base_urls: list
+        Urls of endpoints that take thresholds (e.g. flood-curve).
+    n_requests: int
+        The number of urls to create.
+
+    Returns
+    ------------
+    urls: list
+        The urls with a thresholds query, which are all different so
+        none of them is served from the cache.
+    """
+
+    urls = []
+    thresholds = set()
+    while len(urls) < n_requests:
+        threshold = round(random.uniform(0.1, 5), 6)
+        if threshold not in thresholds:
+            thresholds.add(threshold)
+            urls.append('{}?thresholds={}'.format(
+                base_urls[len(urls) % len(base_urls)], threshold))
+    return urls
+
+
+# In[3]:
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load test the St. Vrain REM service')
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--sites', default='hallmeadows',
+                        help='Comma separated site names')
+    parser.add_argument('--endpoints',
+                        default='rem,flood-curve,frames,tiles',
+                        help='Comma separated site endpoints')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--cold-requests', type=int, default=100,
+                        help='Number of uncached threshold requests')
+    parser.add_argument('--concurrency', type=int, default=50)
+    args = parser.parse_args()
+
+    endpoints = args.endpoints.split(',')
+    urls = ['{}/sites/{}/{}'.format(args.url, site, endpoint)
+            for site in args.sites.split(',')
+            for endpoint in endpoints]
+
+    # The first request of each url may run the pipeline, unless the
+    # service has already seen the url, so report each one on its own
+    for url in urls:
+        status, latency = asyncio.run(timed_get(url))
+        print('First: {} {:.2f} s (status {})'.format(url, latency, status))
+
+    # Uncached (cold) latency from requests with thresholds that the
+    # service has not seen, so every one runs a job
+    threshold_urls = ['{}/sites/{}/{}'.format(args.url, site, endpoint)
+                      for site in args.sites.split(',')
+                      for endpoint in endpoints
+                      if endpoint in threshold_endpoints]
+    if threshold_urls and args.cold_requests > 0:
+        cold = asyncio.run(load_test(
+            uncached_urls(threshold_urls, args.cold_requests),
+            args.cold_requests, args.concurrency))
+        print('Cold: {:.1f} requests/s, p50 {:.2f} s, p99 {:.2f} s, '
+              '{} errors'.format(cold['throughput'], cold['p50'] or 0,
+                                 cold['p99'] or 0, cold['errors']))
+
+    # The rest are served from the cache
+    warm = asyncio.run(load_test(urls, args.requests, args.concurrency))
+    print('Warm: {:.0f} requests/s, p50 {:.1f} ms, p99 {:.1f} ms, '
+          '{} errors'.format(warm['throughput'], (warm['p50'] or 0) * 1000,
+                             (warm['p99'] or 0) * 1000, warm['errors']))
+
+
+if __name__ == '__main__':
+    main()